@@ -0,0 +1,26 @@
+"""
+Hypercorn settings for production
+Run with: hypercorn -c file:hypercorn_conf.py softr_webhook:app
+"""
+
+import multiprocessing
+import os
+
+# Each asyncio worker multiplexes many in-flight OpenAI/Airtable waits, so
+# one process per core is enough; extra workers only add CPU for PIL/PyMuPDF
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'asyncio'
+
+# The app splits the OpenAI account rate limits across WEB_CONCURRENCY
+# workers; spawned workers inherit this
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+
+bind = [f"0.0.0.0:{os.getenv('PORT', '5000')}"]
+backlog = 200
+keep_alive_timeout = 5
+
+# Let shutdown submit buffered batch requests and flush pending Airtable writes
+graceful_timeout = 30
+
+accesslog = '-'
+errorlog = '-'
@@ -3,20 +3,65 @@ Invoice Extractor API for Softr Integration - PDF SUPPORT
 This API receives invoice uploads from Softr and extracts data to Airtable
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from quart import Quart, request, jsonify, url_for
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
+from werkzeug.exceptions import HTTPException
+import asyncio
 import os
-import base64
-import json
-from openai import OpenAI
-from pyairtable import Api
-import tempfile
+import pybase64
+import functools
+import glob
+import hashlib
+import importlib
+import orjson
+import sqlite3
+import threading
+import aiofiles
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+from pyairtable import Api, retry_strategy
+import requests
+from urllib3.exceptions import MaxRetryError, ProtocolError, ReadTimeoutError
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing, suppress
 from datetime import datetime
-from PIL import Image
+from urllib.parse import urlsplit
 import io
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
-app = Flask(__name__)
-CORS(app)
+# Logging: records are queued on the request path and written to stderr by
+# a background listener thread, so handlers never block on the stream
+logger = logging.getLogger("softr")
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+logger.propagate = False
+
+_log_queue = SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonify/get_json through orjson; keyword options for json.dumps are ignored"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Quart(__name__)
+app.json = ORJSONProvider(app)
+app = cors(app)
 
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', 'your-openai-api-key')
@@ -24,151 +69,715 @@ AIRTABLE_API_KEY = os.getenv('AIRTABLE_API_KEY', 'your-airtable-token')
 AIRTABLE_BASE_ID = os.getenv('AIRTABLE_BASE_ID', 'your-base-id')
 AIRTABLE_TABLE_NAME = os.getenv('AIRTABLE_TABLE_NAME', 'Invoice')
 
-# Initialize clients
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-airtable_api = Api(AIRTABLE_API_KEY)
+# Largest invoice accepted, for uploads and file_url downloads alike. Quart
+# answers oversized request bodies with 413 before the handler runs
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_MB', '25')) * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Per-call timeouts, so an upstream hiccup fails fast instead of holding a
+# worker for the SDK default (600s). AIRTABLE_TIMEOUT is (connect, read)
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+AIRTABLE_TIMEOUT = (5, int(os.getenv('AIRTABLE_TIMEOUT', '30')))
+UPSTREAM_RETRY_AFTER = 30
+
+# Initialize clients. The SDK retries calls made outside rate_limited_call
+# (Files/Batch API); Airtable retries 429s with exponential backoff
+openai_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    timeout=OPENAI_TIMEOUT,
+    max_retries=2,
+    # HTTP/2 multiplexes concurrent extractions over a few TLS connections
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    )
+)
+airtable_api = Api(
+    AIRTABLE_API_KEY,
+    timeout=AIRTABLE_TIMEOUT,
+    # Writes are POSTs: after a read timeout or 5xx Airtable may already have
+    # created the rows, so only 429s (rejected unprocessed) and failed
+    # connects are retried - never a request that might have landed
+    retry_strategy=retry_strategy(
+        status_forcelist=(429,),
+        backoff_factor=1,
+        total=2,
+        read=0
+    )
+)
 airtable_table = airtable_api.table(AIRTABLE_BASE_ID, AIRTABLE_TABLE_NAME)
 
+# Shared client for file_url downloads, so TLS connections to the Softr/S3
+# CDNs are reused across webhooks. The transport retries failed connects;
+# retryable HTTP statuses are handled in download_file
+http_client = httpx.AsyncClient(
+    follow_redirects=True,
+    timeout=httpx.Timeout(30.0),
+    transport=httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    )
+)
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_RETRY_STATUSES = {429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# How the invoice image reaches the model: 'inline' sends a base64 data URL
+# through chat.completions, 'files' uploads the raw bytes once via the Files
+# API and references them by file_id through the Responses API
+OPENAI_IMAGE_UPLOAD = os.getenv('OPENAI_IMAGE_UPLOAD', 'inline')
+
+# With OPENAI_FETCH_IMAGE_URLS=1, an https file_url pointing at an image is
+# handed to the model as-is instead of being downloaded and re-sent as
+# base64 (inline mode only; PDFs still need rendering here). Dedupe then
+# keys on the URL rather than the content, and a URL the model can't fetch
+# falls back to the download path
+OPENAI_FETCH_IMAGE_URLS = os.getenv('OPENAI_FETCH_IMAGE_URLS', '0') == '1'
+
+EXTRACTION_PROMPT = """Extract the following information from this invoice and return as JSON:
+{
+    "invoice_number": "string",
+    "invoice_date": "YYYY-MM-DD",
+    "vendor_name": "string",
+    "vendor_address": "string",
+    "customer_name": "string",
+    "customer_address": "string",
+    "subtotal": number,
+    "tax": number,
+    "total_amount": number,
+    "currency": "string",
+    "line_items": [
+        {
+            "description": "string",
+            "quantity": number,
+            "unit_price": number,
+            "amount": number
+        }
+    ]
+}
+Return a JSON object with these exact keys. Use null for missing fields."""
+
+# The prompt part never changes, so every request shares this one dict
+_PROMPT_PART = {"type": "text", "text": EXTRACTION_PROMPT}
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+# Used when several invoices share one request (OPENAI_IMAGES_PER_REQUEST > 1)
+_MULTI_PROMPT_PART = {
+    "type": "text",
+    "text": EXTRACTION_PROMPT + "\n\nSeveral separate invoices follow, each introduced by "
+    "\"Invoice N:\". Return {\"invoices\": [...]} with one such object per "
+    "invoice, in the same order."
+}
+
+# Multi-image requests: invoices arriving within OPENAI_BATCH_WINDOW seconds
+# are sent together, up to OPENAI_IMAGES_PER_REQUEST. 1 (default) disables it
+OPENAI_IMAGES_PER_REQUEST = max(1, int(os.getenv('OPENAI_IMAGES_PER_REQUEST', '1')))
+OPENAI_BATCH_WINDOW = float(os.getenv('OPENAI_BATCH_WINDOW', '0.2'))
+
+# OpenAI rate limiting for the realtime path. Limits are per account, so they
+# are split across the worker processes (WEB_CONCURRENCY)
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '10'))
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', '500'))
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', '30000'))
+OPENAI_PROBE_RATE_LIMITS = os.getenv('OPENAI_PROBE_RATE_LIMITS', '1') == '1'
+OPENAI_MAX_ATTEMPTS = 3
+WORKER_COUNT = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+
+# Rough per-image cost of a high-detail vision input (six 512px tiles at the
+# 1536px cap below), used for TPM budgeting. Low detail is a flat 85 tokens
+ESTIMATED_IMAGE_TOKENS = 1105
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+# Image preprocessing: GPT-4o bills vision input per 512px tile, so larger
+# images only cost more. OPENAI_IMAGE_DETAIL=auto sends small images as "low"
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '1536'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+IMAGE_DETAIL = os.getenv('OPENAI_IMAGE_DETAIL', 'auto')
+EXIF_ORIENTATION = 0x0112
+
+# Airtable writes are coalesced into batch_create calls (max 10 records each)
+AIRTABLE_BATCH_SIZE = 10
+AIRTABLE_FLUSH_INTERVAL = float(os.getenv('AIRTABLE_FLUSH_INTERVAL', '2'))
+
+# Extraction cache: re-uploads of the same file (Softr retries, double
+# submits) reuse the earlier result instead of calling OpenAI again.
+# Set INVOICE_CACHE_PATH to an empty string to disable it
+INVOICE_CACHE_PATH = os.getenv('INVOICE_CACHE_PATH', 'invoice_cache.sqlite3')
+INVOICE_CACHE_TTL = int(os.getenv('INVOICE_CACHE_TTL', str(30 * 86400)))
+
+# Per-worker LRU in front of the SQLite cache, so repeats seen recently by
+# this worker skip the database too. 0 disables it
+INVOICE_MEMORY_CACHE_SIZE = int(os.getenv('INVOICE_MEMORY_CACHE_SIZE', '1024'))
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+# Background jobs: /webhook acknowledges with 202 and a job id, then
+# processes the invoice after responding. Job state lives in SQLite so any
+# worker can answer /webhook/status/<job_id>
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', 'invoice_jobs.sqlite3')
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', str(7 * 86400)))
+
+# Jobs run on a fixed pool of JOB_WORKERS tasks per worker process; once
+# JOB_QUEUE_SIZE jobs are waiting, /webhook answers 429 instead of queueing more
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', str(OPENAI_MAX_CONCURRENCY)))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '100'))
+JOB_DRAIN_TIMEOUT = 25
+job_queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+# ?wait=true requests skip the queue, so they get JOB_WORKERS slots of their
+# own; when all are taken they are answered 429 before the body is read
+wait_slots = asyncio.Semaphore(JOB_WORKERS)
+
+# /webhook jobs not yet finished in this worker, by invoice cache key, so a
+# double-submit joins the running job instead of writing a second record:
+# cache_key -> (job_id, future of process_invoice's result)
+_in_flight = {}
 
-def pdf_to_image(pdf_path):
-    """Convert first page of PDF to image using PyMuPDF"""
+# OpenAI Batch API (non-realtime ingestion via /webhook/batch)
+BATCH_BUFFER_PATH = os.getenv('BATCH_BUFFER_PATH', 'batch_buffer.jsonl')
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', '50'))
+BATCH_MAX_WAIT_SECONDS = float(os.getenv('BATCH_MAX_WAIT_SECONDS', '600'))
+BATCH_POLL_INTERVAL = float(os.getenv('BATCH_POLL_INTERVAL', '30'))
+
+_batch_lock = asyncio.Lock()
+_batch_count = 0
+_batch_started_at = None
+# Result saves of claimed batches, finished before shutdown
+_batch_saves = set()
+
+
+class TokenBucket:
+    """Proactive limiter for OpenAI requests-per-minute and tokens-per-minute"""
+    
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def set_limits(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = min(self._requests, rpm)
+        self._tokens = min(self._tokens, tpm)
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+    
+    async def acquire(self, tokens):
+        """Wait until one request and `tokens` tokens fit in the budget"""
+        tokens = min(tokens, self.tpm)
+        
+        # Waiters queue on the lock, so capacity is handed out in arrival order
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                
+                wait = max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (tokens - self._tokens) * 60 / self.tpm
+                )
+                await asyncio.sleep(wait)
+
+
+REQUEST_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+openai_bucket = TokenBucket(OPENAI_RPM_LIMIT // WORKER_COUNT, OPENAI_TPM_LIMIT // WORKER_COUNT)
+
+
+@functools.lru_cache(maxsize=1)
+def _pdf_backend():
+    """PyMuPDF, imported on first PDF; raises ImportError when not installed"""
+    return importlib.import_module('fitz')
+
+
+@functools.lru_cache(maxsize=1)
+def _pil_image():
+    """PIL.Image, imported on first image so it stays out of cold start"""
+    return importlib.import_module('PIL.Image')
+
+
+@functools.lru_cache(maxsize=1)
+def _pil_image_ops():
+    return importlib.import_module('PIL.ImageOps')
+
+
+def is_pdf(file_bytes):
+    """Sniff the PDF header instead of trusting names (leading whitespace or a BOM is tolerated)"""
+    head = file_bytes[:1024].lstrip(b' \t\r\n\f\x00')
+    if head.startswith(b'\xef\xbb\xbf'):
+        head = head[3:].lstrip(b' \t\r\n\f\x00')
+    return head.startswith(b'%PDF-')
+
+
+def sniff_mime_type(file_bytes):
+    """Mime type from the file's magic bytes, or None if it isn't a supported format"""
+    # Image signatures are fixed at offset 0, so check them before the
+    # looser PDF header (a JPEG comment may well contain "%PDF")
+    if file_bytes.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if file_bytes.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if file_bytes[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if file_bytes[:4] == b'RIFF' and file_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    if is_pdf(file_bytes):
+        return 'application/pdf'
+    return None
+
+
+def pdf_to_image_bytes(pdf_bytes):
+    """Render first page of PDF to JPEG bytes using PyMuPDF"""
     try:
-        import fitz  # PyMuPDF
+        fitz = _pdf_backend()
         
-        print(f"📄 Opening PDF: {pdf_path}")
+        logger.info("Opening PDF: %d bytes", len(pdf_bytes))
         
-        # Open PDF
-        pdf_document = fitz.open(pdf_path)
+        # Open PDF straight from memory
+        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
         
         if pdf_document.page_count == 0:
             raise Exception("PDF has no pages")
         
-        print(f"📊 PDF has {pdf_document.page_count} page(s)")
+        logger.info("PDF has %d page(s)", pdf_document.page_count)
         
         # Get first page
         page = pdf_document[0]
         
-        # Render page to image (higher DPI for better quality)
-        # Matrix(2, 2) means 2x zoom = 144 DPI
-        mat = fitz.Matrix(2, 2)
+        # Render page straight at the size we send to the model (at most
+        # 2x zoom = 144 DPI), so the JPEG needs no further resize
+        zoom = min(2, IMAGE_MAX_DIMENSION / max(page.rect.width, page.rect.height))
+        mat = fitz.Matrix(zoom, zoom)
         pix = page.get_pixmap(matrix=mat)
         
-        print(f"📐 Rendered image: {pix.width}x{pix.height} pixels")
-        
-        # Convert to PNG bytes
-        img_bytes = pix.tobytes("png")
+        logger.info("Rendered image: %dx%d pixels", pix.width, pix.height)
         
-        # Save as temporary PNG
-        img_path = pdf_path.replace('.pdf', '.png')
-        with open(img_path, 'wb') as f:
-            f.write(img_bytes)
+        # JPEG encodes scanned pages much faster and smaller than PNG
+        img_bytes = pix.tobytes("jpeg", jpg_quality=IMAGE_JPEG_QUALITY)
         
         pdf_document.close()
         
-        print(f"✅ PDF converted successfully: {img_path}")
-        return img_path
+        logger.info("PDF converted successfully")
+        return img_bytes
         
     except ImportError as e:
-        print(f"❌ PyMuPDF (fitz) not found: {e}")
+        logger.error("PyMuPDF (fitz) not found: %s", e)
         raise Exception("PDF processing library not installed. Please contact administrator.")
     except Exception as e:
-        print(f"❌ PDF conversion failed: {e}")
+        logger.error("PDF conversion failed: %s", e)
         raise Exception(f"Failed to convert PDF: {str(e)}")
 
 
-def extract_invoice_data(file_path):
-    """Extract data from invoice using OpenAI Vision - supports images and PDFs"""
+def downscale_image(image_bytes, mime_type):
+    """
+    Fit the image within IMAGE_MAX_DIMENSION and re-encode as JPEG
+    Returns (image_bytes, mime_type, width, height)
+    """
+    Image = _pil_image()
+    img = Image.open(io.BytesIO(image_bytes))
+    width, height = img.size
+    
+    # Phone photos are often stored sideways with an EXIF Orientation tag,
+    # which the re-encode below would drop
+    rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
     
-    original_path = file_path
+    # Already an upright JPEG of acceptable size - avoid a lossy re-encode
+    if mime_type == 'image/jpeg' and not rotated and max(width, height) <= IMAGE_MAX_DIMENSION:
+        return image_bytes, mime_type, width, height
+    
+    if rotated:
+        img = _pil_image_ops().exif_transpose(img)
+    
+    # JPEG has no alpha, and a plain convert('RGB') turns transparent pixels
+    # black - flatten those onto white (after resizing, which is cheaper)
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    if has_alpha:
+        img = img.convert('RGBA')
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    
+    if has_alpha:
+        background = Image.new('RGB', img.size, 'white')
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    
+    logger.info("Resized %dx%d -> %dx%d: %d -> %d bytes", width, height, img.width, img.height, len(image_bytes), buf.tell())
+    return buf.getvalue(), 'image/jpeg', img.width, img.height
+
+
+def image_detail(width, height):
+    """Vision detail level: low-detail input is a fixed 512px view"""
+    if IMAGE_DETAIL != 'auto':
+        return IMAGE_DETAIL
+    return 'low' if max(width, height) <= 512 else 'high'
+
+
+async def prepare_image(image_bytes, mime_type):
+    """
+    Turn the uploaded invoice into a compact image the model accepts
+    Returns (image_bytes, mime_type, detail)
+    """
     
     # Check if file is PDF
-    if file_path.lower().endswith('.pdf'):
-        print("📄 PDF detected - converting to image...")
-        file_path = pdf_to_image(file_path)
-    
-    # Read and encode image
-    print(f"📖 Reading file: {file_path}")
-    with open(file_path, "rb") as image_file:
-        image_data = image_file.read()
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-    
-    # Detect image type
-    file_ext = file_path.lower().split('.')[-1]
-    mime_type_map = {
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'gif': 'image/gif',
-        'webp': 'image/webp'
-    }
-    mime_type = mime_type_map.get(file_ext, 'image/png')
+    if is_pdf(image_bytes):
+        logger.info("PDF detected - converting to image")
+        # PyMuPDF is blocking - keep it off the event loop
+        image_bytes = await asyncio.to_thread(pdf_to_image_bytes, image_bytes)
+        mime_type = 'image/jpeg'
     
-    print(f"📤 Sending to OpenAI - Type: {mime_type}, Size: {len(image_data)} bytes")
+    image_bytes, mime_type, width, height = await asyncio.to_thread(downscale_image, image_bytes, mime_type)
     
-    # Call OpenAI API
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    return image_bytes, mime_type, image_detail(width, height)
+
+
+async def build_image_part(image_bytes, mime_type):
+    """The image_url content part for an invoice - supports images and PDFs"""
+    
+    image_bytes, mime_type, detail = await prepare_image(image_bytes, mime_type)
+    
+    # Encode image
+    base64_image = pybase64.b64encode(image_bytes).decode('ascii')
+    
+    logger.info("Prepared image - type: %s, size: %d bytes", mime_type, len(image_bytes))
+    
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{mime_type};base64,{base64_image}",
+            "detail": detail
+        }
+    }
+
+
+def extraction_payload(content, max_tokens=1000):
+    """chat.completions payload for a single user message"""
+    return {
+        "model": "gpt-4o",
+        "messages": [
             {
                 "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": """Extract the following information from this invoice and return as JSON:
-                        {
-                            "invoice_number": "string",
-                            "invoice_date": "YYYY-MM-DD",
-                            "vendor_name": "string",
-                            "vendor_address": "string",
-                            "customer_name": "string",
-                            "customer_address": "string",
-                            "subtotal": number,
-                            "tax": number,
-                            "total_amount": number,
-                            "currency": "string",
-                            "line_items": [
-                                {
-                                    "description": "string",
-                                    "quantity": number,
-                                    "unit_price": number,
-                                    "amount": number
-                                }
-                            ]
-                        }
-                        Return ONLY valid JSON. Use null for missing fields."""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{base64_image}"
-                        }
-                    }
-                ]
+                "content": content
             }
         ],
-        max_tokens=1000
+        "max_tokens": max_tokens,
+        # JSON mode: the reply is a bare JSON object, never fenced markdown
+        "response_format": _JSON_RESPONSE_FORMAT
+    }
+
+
+async def build_extraction_request(image_bytes, mime_type):
+    """Build the chat.completions payload for an invoice - supports images and PDFs"""
+    return extraction_payload([_PROMPT_PART, await build_image_part(image_bytes, mime_type)])
+
+
+def estimate_request_tokens(payload):
+    """Approximate the tokens OpenAI counts against TPM for a chat payload"""
+    tokens = payload.get("max_tokens", 0)
+    
+    for message in payload["messages"]:
+        for part in message["content"]:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            elif part["image_url"].get("detail") == "low":
+                tokens += LOW_DETAIL_IMAGE_TOKENS
+            else:
+                tokens += ESTIMATED_IMAGE_TOKENS
+    
+    return tokens
+
+
+# Raised once OpenAI or Airtable retries are exhausted; answered with 503 so
+# Softr backs off instead of failing the webhook outright. Airtable errors
+# after the request was sent become AirtableWriteUnconfirmed instead, since
+# resending those could duplicate the record
+UPSTREAM_UNAVAILABLE_ERRORS = (
+    RateLimitError, APIConnectionError, InternalServerError,
+    requests.exceptions.RetryError, requests.exceptions.ConnectionError
+)
+
+
+def _retry_delay(error, attempt):
+    """Use the server's Retry-After hint when present, else exponential backoff"""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        # An HTTP-date Retry-After isn't worth parsing - fall back to backoff
+        with suppress(ValueError):
+            if retry_after:
+                return min(float(retry_after), 60.0)
+    return float(2 ** attempt)
+
+
+async def rate_limited_call(make_request, estimated_tokens):
+    """
+    Run make_request(client) under the concurrency limit and token bucket,
+    retrying rate-limit and transient errors up to OPENAI_MAX_ATTEMPTS times
+    """
+    for attempt in range(1, OPENAI_MAX_ATTEMPTS + 1):
+        async with REQUEST_SEM:
+            await openai_bucket.acquire(estimated_tokens)
+            try:
+                # Retries are handled here, not stacked on top of the SDK's own
+                return await make_request(openai_client.with_options(max_retries=0))
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == OPENAI_MAX_ATTEMPTS:
+                    raise
+                error_name = type(e).__name__
+                delay = _retry_delay(e, attempt)
+        
+        # Back off outside the semaphore so other requests can proceed
+        logger.warning("OpenAI %s - retrying in %.1fs (attempt %d/%d)", error_name, delay, attempt, OPENAI_MAX_ATTEMPTS)
+        await asyncio.sleep(delay)
+
+
+async def create_chat_completion(payload):
+    """Rate-limited chat.completions call"""
+    return await rate_limited_call(
+        lambda client: client.chat.completions.create(**payload),
+        estimate_request_tokens(payload)
+    )
+
+
+async def request_via_file_upload(image_bytes, mime_type):
+    """
+    Upload the image with the Files API and reference it by file_id through
+    the Responses API, avoiding the 4/3 base64 inflation in the request body
+    Returns the model's text reply
+    """
+    image_bytes, mime_type, detail = await prepare_image(image_bytes, mime_type)
+    
+    uploaded = await openai_client.files.create(
+        file=(f"invoice.{mime_type.split('/')[-1]}", image_bytes, mime_type),
+        purpose="vision"
     )
+    logger.info("Uploaded image as %s (%d bytes)", uploaded.id, len(image_bytes))
+    
+    try:
+        response = await rate_limited_call(
+            lambda client: client.responses.create(
+                model="gpt-4o",
+                input=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "input_text", "text": EXTRACTION_PROMPT},
+                            {"type": "input_image", "file_id": uploaded.id, "detail": detail}
+                        ]
+                    }
+                ],
+                max_output_tokens=1000,
+                text={"format": _JSON_RESPONSE_FORMAT}
+            ),
+            len(EXTRACTION_PROMPT) // 4 + 1000
+            + (LOW_DETAIL_IMAGE_TOKENS if detail == 'low' else ESTIMATED_IMAGE_TOKENS)
+        )
+    finally:
+        try:
+            await openai_client.files.delete(uploaded.id)
+        except Exception as e:
+            logger.warning("Could not delete uploaded file %s: %s", uploaded.id, e)
+    
+    return response.output_text
+
+
+async def probe_rate_limits():
+    """Read the account's RPM/TPM limits from a 1-token request's headers"""
+    # Runs in before_serving: keep it well inside Hypercorn's startup_timeout
+    # so a slow API falls back to the configured limits instead
+    client = openai_client.with_options(timeout=5, max_retries=0)
+    raw = await client.chat.completions.with_raw_response.create(
+        model="gpt-4o",
+        messages=[{"role": "user", "content": "ping"}],
+        max_tokens=1
+    )
+    rpm = raw.headers.get('x-ratelimit-limit-requests')
+    tpm = raw.headers.get('x-ratelimit-limit-tokens')
+    
+    if rpm and tpm:
+        openai_bucket.set_limits(int(rpm) // WORKER_COUNT, int(tpm) // WORKER_COUNT)
+        logger.info("OpenAI limits: %s RPM / %s TPM (this worker: %d / %d)", rpm, tpm, openai_bucket.rpm, openai_bucket.tpm)
+
+
+def parse_invoice_content(content):
+    """Parse the model's reply (JSON mode) into invoice data"""
+    return orjson.loads(content)
+
+
+async def complete_extraction(payload):
+    """
+    Run an extraction payload and return the reply text
+    A reply cut off at max_tokens (long line-item lists) is retried once with
+    high-detail images and twice the output budget
+    """
+    response = await create_chat_completion(payload)
+    
+    if response.choices[0].finish_reason == 'length':
+        logger.warning("OpenAI reply truncated - retrying with detail=high, max_tokens=%d", payload["max_tokens"] * 2)
+        # Copy the parts - callers (ExtractionBatcher's per-invoice fallback)
+        # may reuse them and must keep their original detail
+        content = [
+            {**part, "image_url": {**part["image_url"], "detail": "high"}} if part["type"] == "image_url" else part
+            for part in payload["messages"][0]["content"]
+        ]
+        response = await create_chat_completion(extraction_payload(content, payload["max_tokens"] * 2))
+    
+    return response.choices[0].message.content
+
+
+class ExtractionBatcher:
+    """
+    Coalesces invoices arriving within window seconds into one multi-image
+    chat.completions call (up to batch_size images), so the prompt is sent
+    and prefilled once per group. If the combined reply can't be matched
+    back to the invoices, each one is extracted on its own instead.
+    """
+    
+    def __init__(self, batch_size, window):
+        self.batch_size = batch_size
+        self.window = window
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+    
+    async def extract(self, image_part):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((image_part, future))
+        
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        
+        return await future
+    
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            self._pending = self._pending[self.batch_size:]
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _send(self, batch):
+        if len(batch) == 1:
+            image_part, future = batch[0]
+            try:
+                invoice_data = parse_invoice_content(await complete_extraction(
+                    extraction_payload([_PROMPT_PART, image_part])
+                ))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            
+            if not future.done():
+                future.set_result(invoice_data)
+            return
+        
+        content = [_MULTI_PROMPT_PART]
+        for number, (image_part, _) in enumerate(batch, 1):
+            content.append({"type": "text", "text": f"Invoice {number}:"})
+            content.append(image_part)
+        
+        logger.info("Extracting %d invoices in one request", len(batch))
+        try:
+            invoices = parse_invoice_content(await complete_extraction(
+                extraction_payload(content, max_tokens=1000 * len(batch))
+            ))["invoices"]
+            if len(invoices) != len(batch):
+                raise ValueError(f"expected {len(batch)} invoices, got {len(invoices)}")
+        except UPSTREAM_UNAVAILABLE_ERRORS as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except Exception as e:
+            logger.warning("Multi-invoice reply unusable (%s) - extracting %d invoices separately", e, len(batch))
+            await asyncio.gather(*(self._send([item]) for item in batch))
+            return
+        
+        for (_, future), invoice_data in zip(batch, invoices):
+            if not future.done():
+                future.set_result(invoice_data)
+
+
+extraction_batcher = ExtractionBatcher(OPENAI_IMAGES_PER_REQUEST, OPENAI_BATCH_WINDOW)
+
+
+async def extract_from_image_part(image_part):
+    """Inline chat.completions extraction for one image_url content part"""
+    if extraction_batcher.batch_size > 1:
+        logger.info("Queueing for a multi-invoice OpenAI request")
+        return await extraction_batcher.extract(image_part)
+    
+    logger.info("Sending to OpenAI")
+    content = await complete_extraction(extraction_payload([_PROMPT_PART, image_part]))
     
     # Parse response
-    content = response.choices[0].message.content
-    print(f"🤖 OpenAI response received: {len(content)} chars")
+    logger.info("OpenAI response received: %d chars", len(content))
     
-    if "```json" in content:
-        content = content.split("```json")[1].split("```")[0]
-    elif "```" in content:
-        content = content.split("```")[1].split("```")[0]
+    return parse_invoice_content(content)
+
+
+async def extract_invoice_data(image_bytes, mime_type, image_url=None):
+    """
+    Extract data from invoice using OpenAI Vision - supports images and PDFs
+    With image_url (see passthrough_image_url) the model fetches the image
+    itself and image_bytes/mime_type are unused unless that fails
+    """
     
-    return json.loads(content.strip())
+    if image_url is not None:
+        try:
+            return await extract_from_image_part({
+                "type": "image_url",
+                "image_url": {"url": image_url, "detail": IMAGE_DETAIL}
+            })
+        except BadRequestError as e:
+            logger.warning("OpenAI could not use the image URL (%s) - downloading it instead", e)
+            try:
+                image_bytes, _ = await download_file(image_url)
+            except FileTooLarge:
+                raise ValueError(f"file_url is larger than the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit")
+            mime_type = sniff_mime_type(image_bytes)
+            if mime_type is None:
+                raise ValueError("file_url is not a supported image or PDF")
+    
+    # Call OpenAI API
+    if OPENAI_IMAGE_UPLOAD == 'files':
+        content = await request_via_file_upload(image_bytes, mime_type)
+        logger.info("OpenAI response received: %d chars", len(content))
+        return parse_invoice_content(content)
+    
+    return await extract_from_image_part(await build_image_part(image_bytes, mime_type))
 
 
-def save_to_airtable(invoice_data):
-    """Save extracted data to Airtable"""
+def build_airtable_record(invoice_data):
+    """Map extracted invoice data to Airtable fields"""
     
     # Format line items
-    line_items_text = "\n".join([
+    # (line_items may come back as null - the prompt asks for null when missing)
+    line_items_text = "\n".join(
         f"{item.get('description', 'N/A')} - Qty: {item.get('quantity', 0)} × ${item.get('unit_price', 0)} = ${item.get('amount', 0)}"
-        for item in invoice_data.get('line_items', [])
-    ])
+        for item in invoice_data.get('line_items') or ()
+    )
     
     # Prepare record
     record = {
@@ -186,17 +795,616 @@ def save_to_airtable(invoice_data):
     }
     
     # Remove None values
-    record = {k: v for k, v in record.items() if v is not None}
+    return {k: v for k, v in record.items() if v is not None}
+
+
+class AirtableWriteUnconfirmed(Exception):
+    """Raised when an Airtable create was sent but may or may not have landed"""
+
+
+class AirtableBatcher:
+    """
+    Coalesces record creates into batch_create calls
+    A batch is sent once batch_size records are waiting or flush_interval
+    seconds after the first one arrived; each caller gets its own record back.
+    All state is touched only from the event loop, so no lock is needed.
+    """
+    
+    def __init__(self, table, batch_size, flush_interval):
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+    
+    async def create(self, record, immediate=False):
+        """Queue a record; immediate=True sends it (with anything pending) right away"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((record, future))
+        
+        if immediate or len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+        
+        return await future
+    
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            self._pending = self._pending[self.batch_size:]
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def drain(self):
+        """Send everything pending and wait for the in-flight batches"""
+        self.flush()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    async def _send(self, batch):
+        logger.info("Creating %d Airtable record(s)", len(batch))
+        try:
+            # pyairtable is synchronous - run it in a worker thread
+            # typecast lets Airtable coerce dates/numbers and add select options
+            created = await asyncio.to_thread(self.table.batch_create, [record for record, _ in batch], typecast=True)
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if len(batch) == 1 or status is None or status >= 500:
+                self._fail(batch, e)
+                return
+            
+            # Airtable rejects the whole batch for one bad record (e.g. 422
+            # INVALID_VALUE_FOR_COLUMN) - create them one by one so only
+            # that invoice fails
+            logger.warning("Airtable rejected a batch of %d (%s) - creating records individually", len(batch), status)
+            await asyncio.gather(*(self._create_one(record, future) for record, future in batch))
+            return
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        
+        for (_, future), created_record in zip(batch, created):
+            if not future.done():
+                future.set_result(created_record)
+    
+    async def _create_one(self, record, future):
+        try:
+            created_record = await asyncio.to_thread(self.table.create, record, typecast=True)
+        except Exception as e:
+            self._fail([(record, future)], e)
+            return
+        
+        if not future.done():
+            future.set_result(created_record)
+    
+    @classmethod
+    def _fail(cls, batch, error):
+        if cls._may_have_landed(error):
+            unconfirmed = AirtableWriteUnconfirmed(f"Airtable did not confirm the write, check Airtable before resending: {error}")
+            unconfirmed.__cause__ = error
+            error = unconfirmed
+        
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+
+    @staticmethod
+    def _may_have_landed(error):
+        """True for failures after the request reached Airtable (read timeout, dropped reply, 5xx)"""
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is not None and error.response.status_code >= 500
+        if isinstance(error, (requests.exceptions.ReadTimeout, requests.exceptions.ChunkedEncodingError)):
+            return True
+        # With read=0 urllib3 gives up on the first read error and requests
+        # reports it as a ConnectionError wrapping MaxRetryError
+        reason = error.args[0] if isinstance(error, requests.exceptions.ConnectionError) and error.args else None
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, (ReadTimeoutError, ProtocolError))
+
+
+airtable_batcher = AirtableBatcher(airtable_table, AIRTABLE_BATCH_SIZE, AIRTABLE_FLUSH_INTERVAL)
+
+
+async def save_to_airtable(invoice_data, immediate=False):
+    """Save extracted data to Airtable; immediate=True skips the flush wait"""
+    return await airtable_batcher.create(build_airtable_record(invoice_data), immediate)
+
+
+def invoice_cache_key(file_bytes):
+    """Content hash of the uploaded file (SHA-256 is hardware-accelerated via OpenSSL)"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def init_invoice_cache():
+    """Create the cache table; WAL lets every worker process share the file"""
+    with closing(sqlite3.connect(INVOICE_CACHE_PATH)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS invoice_cache (
+                key TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                airtable_record_id TEXT,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("DELETE FROM invoice_cache WHERE expires_at < ?", (time.time(),))
+        conn.commit()
+
+
+def _memory_cache_put(key, invoice_data, airtable_record_id, expires_at):
+    if INVOICE_MEMORY_CACHE_SIZE <= 0:
+        return
+    
+    # cache_get/cache_put run in worker threads, hence the lock
+    with _memory_cache_lock:
+        _memory_cache[key] = (expires_at, invoice_data, airtable_record_id)
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > INVOICE_MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def cache_get(key):
+    """Return (invoice_data, airtable_record_id) for a cached upload, or None"""
+    if not INVOICE_CACHE_PATH:
+        return None
+    
+    now = time.time()
+    with _memory_cache_lock:
+        entry = _memory_cache.get(key)
+        if entry is not None:
+            if entry[0] >= now:
+                _memory_cache.move_to_end(key)
+                return entry[1], entry[2]
+            del _memory_cache[key]
+    
+    try:
+        with closing(sqlite3.connect(INVOICE_CACHE_PATH, timeout=5)) as conn:
+            row = conn.execute(
+                "SELECT data, airtable_record_id, expires_at FROM invoice_cache WHERE key = ? AND expires_at >= ?",
+                (key, now)
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning("Cache lookup failed: %s", e)
+        return None
+    
+    if row is None:
+        return None
+    
+    invoice_data = orjson.loads(row[0])
+    _memory_cache_put(key, invoice_data, row[1], row[2])
+    return invoice_data, row[1]
+
+
+def cache_put(key, invoice_data, airtable_record_id):
+    """Remember the extraction and Airtable record for an upload"""
+    if not INVOICE_CACHE_PATH:
+        return
+    
+    expires_at = time.time() + INVOICE_CACHE_TTL
+    _memory_cache_put(key, invoice_data, airtable_record_id, expires_at)
+    
+    try:
+        with closing(sqlite3.connect(INVOICE_CACHE_PATH, timeout=5)) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO invoice_cache VALUES (?, ?, ?, ?)",
+                (key, orjson.dumps(invoice_data).decode(), airtable_record_id, expires_at)
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.warning("Cache write failed: %s", e)
+
+
+def init_job_store():
+    """Create the jobs table and drop jobs past their retention period"""
+    with closing(sqlite3.connect(JOBS_DB_PATH)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # Submitted Batch API jobs, until one worker collects their results
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id TEXT PRIMARY KEY,
+                submitted_at REAL NOT NULL
+            )
+        """)
+        conn.execute("DELETE FROM jobs WHERE updated_at < ?", (time.time() - JOB_RETENTION_SECONDS,))
+        conn.commit()
+
+
+def job_update(job_id, status, result=None, error=None):
+    """Insert or update a job's status ('queued', 'processing', 'finished', 'failed', 'unknown')"""
+    with closing(sqlite3.connect(JOBS_DB_PATH, timeout=5)) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)",
+            (job_id, status, orjson.dumps(result).decode() if result is not None else None, error, time.time())
+        )
+        conn.commit()
+
+
+def job_get(job_id):
+    """Return the job as a dict, or None if unknown"""
+    with closing(sqlite3.connect(JOBS_DB_PATH, timeout=5)) as conn:
+        row = conn.execute(
+            "SELECT status, result, error FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    
+    if row is None:
+        return None
+    
+    job = {"job_id": job_id, "status": row[0]}
+    if row[1] is not None:
+        job["result"] = orjson.loads(row[1])
+    if row[2] is not None:
+        job["error"] = row[2]
+    return job
+
+
+def batch_job_begin(cache_key, job_id):
+    """
+    Record a /webhook/batch job as queued unless the same invoice already is
+    Returns the id of the job that will produce the result
+    """
+    with closing(sqlite3.connect(JOBS_DB_PATH, timeout=5, isolation_level=None)) as conn:
+        # IMMEDIATE takes the write lock up front so two workers can't both miss
+        conn.execute("BEGIN IMMEDIATE")
+        # Batch job ids are "<cache key>-<suffix>", so this is a key range scan
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE id > ? AND id < ? AND status = 'queued' LIMIT 1",
+            (cache_key + '-', cache_key + '.')
+        ).fetchone()
+        if row is None:
+            conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, 'queued', NULL, NULL, ?)", (job_id, time.time()))
+        conn.execute("COMMIT")
+    return job_id if row is None else row[0]
+
+
+def batch_track(batch_id):
+    """Persist a submitted batch so it survives restarts"""
+    with closing(sqlite3.connect(JOBS_DB_PATH, timeout=5)) as conn:
+        conn.execute("INSERT OR IGNORE INTO batches VALUES (?, ?)", (batch_id, time.time()))
+        conn.commit()
+
+
+def batch_pending_ids():
+    """Batches submitted by any worker and not yet collected"""
+    with closing(sqlite3.connect(JOBS_DB_PATH, timeout=5)) as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM batches ORDER BY submitted_at")]
+
+
+def batch_claim(batch_id):
+    """Take a finished batch off the pending list; True for exactly one worker"""
+    with closing(sqlite3.connect(JOBS_DB_PATH, timeout=5)) as conn:
+        claimed = conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,)).rowcount == 1
+        conn.commit()
+    return claimed
+
+
+def _batch_buffer_path(pid=None):
+    """Buffer file for this worker process (each Hypercorn worker keeps its own)"""
+    root, ext = os.path.splitext(BATCH_BUFFER_PATH)
+    return f"{root}.{os.getpid() if pid is None else pid}{ext or '.jsonl'}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def adopt_batch_buffers():
+    """
+    Take over buffer files left by workers that died before flushing
+    Returns the number of requests now in this worker's buffer
+    """
+    root, ext = os.path.splitext(BATCH_BUFFER_PATH)
+    ext = ext or '.jsonl'
+    own_path = _batch_buffer_path()
+    
+    for path in glob.glob(f"{glob.escape(root)}.*{glob.escape(ext)}"):
+        pid = path[len(root) + 1:-len(ext)]
+        if path == own_path or not pid.isdigit() or _pid_alive(int(pid)):
+            continue
+        
+        # rename is atomic, so only one starting worker gets each orphan
+        claimed_path = f"{path}.{os.getpid()}.adopting"
+        try:
+            os.rename(path, claimed_path)
+        except FileNotFoundError:
+            continue
+        
+        with open(claimed_path, 'rb') as src, open(own_path, 'ab') as dst:
+            dst.write(src.read())
+        os.unlink(claimed_path)
+        logger.info("Adopted batch buffer %s", path)
+    
+    if not os.path.exists(own_path):
+        return 0
+    with open(own_path, 'rb') as f:
+        return sum(1 for line in f if line.strip())
+
+
+async def queue_batch_request(custom_id, payload):
+    """Append one chat.completions request to the Batch API buffer"""
+    global _batch_count, _batch_started_at
+    
+    line = orjson.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": payload
+    }) + b"\n"
+    
+    async with _batch_lock:
+        async with aiofiles.open(_batch_buffer_path(), 'ab') as f:
+            await f.write(line)
+        _batch_count += 1
+        if _batch_started_at is None:
+            _batch_started_at = time.monotonic()
+        buffer_full = _batch_count >= BATCH_MAX_REQUESTS
+    
+    logger.info("Queued batch request %s (%d/%d)", custom_id, _batch_count, BATCH_MAX_REQUESTS)
+    
+    if buffer_full:
+        # The request is safely buffered either way; failing here would make
+        # the producer retry and create a duplicate. batch_worker retries
+        try:
+            await flush_batch_buffer()
+        except Exception as e:
+            logger.error("Could not submit buffered batch requests, will retry: %s", e)
+
+
+async def flush_batch_buffer():
+    """Upload the buffered requests to OpenAI and start a batch job"""
+    global _batch_count, _batch_started_at
+    
+    async with _batch_lock:
+        if _batch_count == 0:
+            return None
+        
+        buffer_path = _batch_buffer_path()
+        async with aiofiles.open(buffer_path, 'rb') as f:
+            batch_input = await f.read()
+        
+        # The lock is held until the batch exists so a failed upload keeps
+        # the buffer intact for the next attempt
+        uploaded = await openai_client.files.create(
+            file=(os.path.basename(buffer_path), batch_input),
+            purpose="batch"
+        )
+        batch = await openai_client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        logger.info("Submitted batch %s with %d request(s)", batch.id, _batch_count)
+        
+        await asyncio.to_thread(batch_track, batch.id)
+        _batch_count = 0
+        _batch_started_at = None
+        # The batch already exists; a missing buffer file mustn't fail the flush
+        with suppress(FileNotFoundError):
+            os.unlink(buffer_path)
+    
+    return batch.id
+
+
+async def save_batch_result(result):
+    """
+    Save one line of a Batch API output (or error) file to Airtable and
+    record the outcome on its job (the custom_id)
+    """
+    custom_id = result.get('custom_id')
+    response = result.get('response') or {}
+    
+    try:
+        if response.get('status_code') != 200:
+            # Error-file lines carry "error"; non-200 output lines carry it in the body
+            error = result.get('error') or (response.get('body') or {}).get('error') or {}
+            raise Exception(f"status {response.get('status_code')}: {error.get('message', error)}")
+        
+        content = response['body']['choices'][0]['message']['content']
+        invoice_data = parse_invoice_content(content)
+        airtable_record = await save_to_airtable(invoice_data)
+        logger.info("Batch result %s saved to Airtable: %s", custom_id, airtable_record['id'])
+        
+        # custom_id is "<cache key>-<suffix>"
+        cache_key = custom_id.rsplit('-', 1)[0]
+        await asyncio.to_thread(cache_put, cache_key, invoice_data, airtable_record['id'])
+        await asyncio.to_thread(job_update, custom_id, 'finished', invoice_result(invoice_data, airtable_record['id']))
+    except AirtableWriteUnconfirmed as e:
+        logger.error("Batch result %s outcome unknown: %s", custom_id, e)
+        if custom_id:
+            await asyncio.to_thread(job_update, custom_id, 'unknown', None, str(e))
+    except Exception as e:
+        logger.error("Batch result %s failed: %s", custom_id, e)
+        if custom_id:
+            await asyncio.to_thread(job_update, custom_id, 'failed', None, str(e))
+
+
+async def _batch_file_lines(file_id):
+    """Download a Batch API file and parse its JSONL lines"""
+    content = await openai_client.files.content(file_id)
+    return [orjson.loads(line) for line in content.text.splitlines() if line.strip()]
+
+
+async def collect_batch(batch_id):
+    """Save a finished batch's results to Airtable. Returns False while still running."""
+    
+    batch = await openai_client.batches.retrieve(batch_id)
+    
+    if batch.status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+        return False
     
-    print(f"💾 Creating Airtable record with {len(record)} fields")
+    # Download and parse everything before claiming, so a transient failure
+    # here leaves the batch pending for the next poll. The error file holds
+    # the rejected (and, on expiry, unfinished) requests; save_batch_result
+    # marks their jobs failed
+    results = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            results.extend(await _batch_file_lines(file_id))
     
-    # Create in Airtable
-    created_record = airtable_table.create(record)
-    return created_record
+    # A batch that failed validation produces neither file - fail every job in its input
+    failed_ids, error = [], None
+    if batch.status == 'failed' and not batch.output_file_id and not batch.error_file_id:
+        failed_ids = [line['custom_id'] for line in await _batch_file_lines(batch.input_file_id)]
+        error = f"Batch {batch_id} failed: {batch.errors}"
+    
+    # Every worker polls every pending batch; only one saves the results
+    if not await asyncio.to_thread(batch_claim, batch_id):
+        return True
+    
+    if batch.status == 'completed':
+        logger.info("Batch %s completed - saving results to Airtable", batch_id)
+    else:
+        # Expired/cancelled batches may still have partial output
+        logger.error("Batch %s ended with status: %s", batch_id, batch.status)
+    
+    if batch.request_counts and batch.request_counts.failed:
+        logger.warning("Batch %s: %d request(s) failed", batch_id, batch.request_counts.failed)
+    
+    # Save concurrently so the Airtable writes share batch_create calls.
+    # The batch is no longer pending, so the saves are shielded from the
+    # shutdown cancel and awaited by stop_batch_worker instead
+    save = asyncio.gather(
+        *(save_batch_result(result) for result in results),
+        *(asyncio.to_thread(job_update, custom_id, 'failed', None, error) for custom_id in failed_ids)
+    )
+    _batch_saves.add(save)
+    save.add_done_callback(_batch_saves.discard)
+    await asyncio.shield(save)
+    
+    return True
+
+
+async def batch_worker():
+    """Background loop: submit stale buffers and collect finished batches"""
+    
+    while True:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        
+        try:
+            if _batch_started_at is not None and time.monotonic() - _batch_started_at >= BATCH_MAX_WAIT_SECONDS:
+                await flush_batch_buffer()
+            
+            for batch_id in await asyncio.to_thread(batch_pending_ids):
+                await collect_batch(batch_id)
+        except Exception as e:
+            logger.exception("Batch worker error: %s", e)
+
+
+@app.before_serving
+async def open_invoice_cache():
+    if INVOICE_CACHE_PATH:
+        await asyncio.to_thread(init_invoice_cache)
+
+
+@app.before_serving
+async def open_job_store():
+    await asyncio.to_thread(init_job_store)
+
+
+async def job_worker():
+    """Pool task: run queued /webhook jobs one at a time"""
+    while True:
+        args = await job_queue.get()
+        try:
+            # run_invoice_job has logged and recorded the failure
+            with suppress(Exception):
+                await run_invoice_job(*args)
+        finally:
+            job_queue.task_done()
+
+
+@app.before_serving
+async def start_job_workers():
+    app.job_worker_tasks = [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
+
+
+@app.before_serving
+async def start_batch_worker():
+    global _batch_count, _batch_started_at
+    
+    # Requests buffered by a crashed worker (or a previous run with this
+    # PID) are submitted on the first poll
+    _batch_count = await asyncio.to_thread(adopt_batch_buffers)
+    if _batch_count:
+        logger.info("Recovered %d buffered batch request(s)", _batch_count)
+        _batch_started_at = time.monotonic() - BATCH_MAX_WAIT_SECONDS
+    
+    app.batch_worker_task = asyncio.create_task(batch_worker())
+
+
+@app.before_serving
+async def configure_rate_limits():
+    if not OPENAI_PROBE_RATE_LIMITS or OPENAI_API_KEY == 'your-openai-api-key':
+        return
+    
+    try:
+        await probe_rate_limits()
+    except Exception as e:
+        logger.warning("Could not read OpenAI rate limits, using configured values: %s", e)
+
+
+@app.after_serving
+async def stop_job_workers():
+    # Finish accepted jobs before the Airtable batcher and clients shut down
+    try:
+        await asyncio.wait_for(job_queue.join(), JOB_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Shutting down with %d job(s) unfinished", job_queue.qsize())
+    
+    for task in app.job_worker_tasks:
+        task.cancel()
+
+
+@app.after_serving
+async def stop_batch_worker():
+    app.batch_worker_task.cancel()
+    
+    # A claimed batch is no longer pending, so its saves must finish now
+    if _batch_saves:
+        await asyncio.gather(*_batch_saves, return_exceptions=True)
+    
+    # Submit whatever is still buffered so it isn't stranded in this worker's file
+    try:
+        await flush_batch_buffer()
+    except Exception as e:
+        logger.error("Could not submit buffered batch requests: %s", e)
+    
+    # Send any Airtable records still waiting for the flush timer
+    await airtable_batcher.drain()
+    
+    await http_client.aclose()
+    await openai_client.close()
+    
+    pending = await asyncio.to_thread(batch_pending_ids)
+    if pending:
+        logger.info("Batches still running, collected after restart: %s", ', '.join(pending))
 
 
 @app.route('/')
-def home():
+async def home():
     """Health check"""
     return jsonify({
         "status": "active",
@@ -204,134 +1412,461 @@ def home():
         "version": "2.1",
         "supported_formats": ["JPG", "JPEG", "PNG", "PDF"],
         "endpoints": {
-            "/webhook": "POST - Receive invoice from Softr",
+            "/webhook": "POST - Receive invoice from Softr (202 + job_id; ?wait=true to get the result inline)",
+            "/webhook/status/<job_id>": "GET - Status and result of a queued invoice",
+            "/webhook/batch": "POST - Queue invoice for OpenAI Batch API (results saved within 24h)",
             "/health": "GET - Health check"
         }
     })
 
 
+# Accepted upload types: by file extension for multipart uploads, by
+# content type for raw request bodies on /webhook and /webhook/batch
+_MIME_BY_EXT = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'pdf': 'application/pdf'
+}
+_ALLOWED_EXTS = frozenset(_MIME_BY_EXT)
+RAW_UPLOAD_TYPES = frozenset(_MIME_BY_EXT.values())
+
+
+class FileTooLarge(Exception):
+    """Raised when a download exceeds MAX_UPLOAD_BYTES"""
+
+
+async def download_file(file_url):
+    """
+    Fetch file_url over the shared connection pool, retrying 429/5xx with backoff
+    Stops reading once the body passes MAX_UPLOAD_BYTES
+    Returns (file_bytes, content_type)
+    """
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        async with http_client.stream('GET', file_url) as response:
+            if response.status_code not in DOWNLOAD_RETRY_STATUSES or attempt == DOWNLOAD_ATTEMPTS:
+                response.raise_for_status()
+                
+                if int(response.headers.get('content-length') or 0) > MAX_UPLOAD_BYTES:
+                    raise FileTooLarge()
+                
+                file_bytes = bytearray()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    file_bytes += chunk
+                    if len(file_bytes) > MAX_UPLOAD_BYTES:
+                        raise FileTooLarge()
+                return bytes(file_bytes), response.headers.get('content-type', '')
+        
+        delay = 0.3 * 2 ** (attempt - 1)
+        logger.warning("Download returned %d - retrying in %.1fs", response.status_code, delay)
+        await asyncio.sleep(delay)
+
+
+async def passthrough_image_url():
+    """The request's file_url if the model can fetch it directly, else None"""
+    if not OPENAI_FETCH_IMAGE_URLS or OPENAI_IMAGE_UPLOAD != 'inline' or not request.is_json:
+        return None
+    
+    data = await request.get_json()
+    file_url = data.get('file_url') or data.get('attachment_url')
+    if not file_url:
+        return None
+    
+    # Only https image URLs; PDFs are rendered here, so they're downloaded
+    url = urlsplit(file_url)
+    file_ext = os.path.splitext(url.path)[1][1:].lower()
+    if url.scheme != 'https' or file_ext not in _ALLOWED_EXTS or file_ext == 'pdf':
+        return None
+    
+    return file_url
+
+
+def unrecognized_file_response():
+    return jsonify({
+        "error": "Invalid file type",
+        "message": f"File content is not one of: {', '.join(_MIME_BY_EXT)}"
+    }), 400
+
+
+async def receive_invoice():
+    """
+    Read the invoice from the current request into memory
+    Returns (file_bytes, mime_type, None) on success or (None, None, error_response)
+    """
+    
+    # Method 0: Raw body (Content-Type: application/pdf or image/*) - skips
+    # the multipart parser entirely, e.g. fetch(url, {body: file})
+    if request.mimetype in RAW_UPLOAD_TYPES:
+        file_bytes = await request.get_data(cache=False)
+        if not file_bytes:
+            return None, None, (jsonify({"error": "Empty request body"}), 400)
+        
+        mime_type = sniff_mime_type(file_bytes)
+        if mime_type is None:
+            return None, None, unrecognized_file_response()
+        
+        logger.info("Raw upload (type: %s, %d bytes)", mime_type, len(file_bytes))
+        return file_bytes, mime_type, None
+    
+    files = await request.files
+    
+    # Method 1: File upload (multipart/form-data)
+    if 'file' in files:
+        file = files['file']
+        
+        if file.filename == '':
+            return None, None, (jsonify({"error": "No file selected"}), 400)
+        
+        # Get file extension
+        file_ext = os.path.splitext(file.filename)[1][1:].lower() or 'jpg'
+        
+        # Validate file type
+        if file_ext not in _ALLOWED_EXTS:
+            return None, None, (jsonify({
+                "error": "Invalid file type",
+                "message": f"Allowed types: {', '.join(_MIME_BY_EXT)}"
+            }), 400)
+        
+        # Parts over 500 KB are spooled to an anonymous temp file by the form
+        # parser; close it now instead of holding the fd until the request
+        # is garbage collected (background jobs outlive the response)
+        try:
+            file_bytes = file.read()
+        finally:
+            file.close()
+        # Trust the content over the name (e.g. a PNG saved as .jpg)
+        mime_type = sniff_mime_type(file_bytes)
+        if mime_type is None:
+            return None, None, unrecognized_file_response()
+        
+        logger.info("File uploaded: %s (type: %s, %d bytes)", file.filename, mime_type, len(file_bytes))
+        return file_bytes, mime_type, None
+    
+    # Method 2: JSON with file URL (if Softr sends URL)
+    if request.is_json:
+        data = await request.get_json()
+        file_url = data.get('file_url') or data.get('attachment_url')
+        
+        if not file_url:
+            return None, None, (jsonify({"error": "No file_url provided"}), 400)
+        
+        logger.info("Downloading from URL: %s", file_url)
+        
+        # Download file
+        try:
+            file_bytes, content_type = await download_file(file_url)
+        except FileTooLarge:
+            return None, None, (jsonify({
+                "error": "File too large",
+                "message": f"Maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"
+            }), 413)
+        
+        # CDN URLs often have no extension and a generic content-type
+        mime_type = sniff_mime_type(file_bytes)
+        if mime_type is None:
+            logger.warning("Unrecognized download (content-type: %s)", content_type)
+            return None, None, unrecognized_file_response()
+        
+        logger.info("Downloaded %d bytes (type: %s)", len(file_bytes), mime_type)
+        return file_bytes, mime_type, None
+    
+    return None, None, (jsonify({"error": "No file provided. Send file or file_url"}), 400)
+
+
+def invoice_result(invoice_data, airtable_record_id, cached=False):
+    """Result body for a processed invoice"""
+    return {
+        "success": True,
+        "message": "Invoice processed successfully",
+        "invoice_number": invoice_data.get("invoice_number"),
+        "total_amount": invoice_data.get("total_amount"),
+        "currency": invoice_data.get("currency"),
+        "airtable_record_id": airtable_record_id,
+        "cached": cached,
+        "data": invoice_data
+    }
+
+
+def invoice_success_response(invoice_data, airtable_record_id, cached=False):
+    """Response for a processed invoice"""
+    return jsonify(invoice_result(invoice_data, airtable_record_id, cached)), 200
+
+
+def too_busy_response():
+    """429 asking the producer to come back once capacity frees up"""
+    return jsonify({
+        "success": False,
+        "error": "Too many invoices in progress, retry later"
+    }), 429, {"Retry-After": str(UPSTREAM_RETRY_AFTER)}
+
+
+async def process_invoice(file_bytes, mime_type, cache_key, immediate=False, image_url=None):
+    """
+    Extract the invoice, save it to Airtable and cache the result
+    immediate=True (a caller is waiting on the response) sends the Airtable
+    record without waiting for the batch flush interval
+    """
+    
+    # Extract data
+    logger.info("Extracting data with AI")
+    invoice_data = await extract_invoice_data(file_bytes, mime_type, image_url)
+    logger.info("Extracted invoice: %s", invoice_data.get('invoice_number', 'N/A'))
+    
+    # Save to Airtable
+    logger.info("Saving to Airtable")
+    airtable_record = await save_to_airtable(invoice_data, immediate)
+    logger.info("Saved to Airtable: %s", airtable_record['id'])
+    
+    await asyncio.to_thread(cache_put, cache_key, invoice_data, airtable_record['id'])
+    
+    return invoice_data, airtable_record['id']
+
+
+def begin_in_flight(cache_key, job_id):
+    """Register a /webhook job so duplicates of its invoice can join it"""
+    future = asyncio.get_running_loop().create_future()
+    # Nobody may be waiting on it; don't log "exception was never retrieved"
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _in_flight[cache_key] = (job_id, future)
+    return future
+
+
+def end_in_flight(cache_key, future, result=None, error=None):
+    """Unregister a job and hand its outcome to any duplicates waiting on it"""
+    if _in_flight.get(cache_key, (None, None))[1] is future:
+        del _in_flight[cache_key]
+    if future.done():
+        return
+    if isinstance(error, asyncio.CancelledError):
+        future.cancel()
+    elif error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+async def run_invoice_job(job_id, file_bytes, mime_type, cache_key, image_url, future, immediate=False):
+    """
+    Process a /webhook job and record the outcome in the job store
+    Resolves the job's in-flight future and returns (or raises) its result
+    """
+    try:
+        await asyncio.to_thread(job_update, job_id, 'processing')
+        result = await process_invoice(file_bytes, mime_type, cache_key, immediate, image_url)
+        await asyncio.to_thread(job_update, job_id, 'finished', invoice_result(*result))
+        logger.info("Job %s finished", job_id)
+    except AirtableWriteUnconfirmed as e:
+        logger.error("Job %s outcome unknown: %s", job_id, e)
+        await asyncio.to_thread(job_update, job_id, 'unknown', None, str(e))
+        end_in_flight(cache_key, future, error=e)
+        raise
+    except Exception as e:
+        logger.exception("Job %s failed: %s", job_id, e)
+        await asyncio.to_thread(job_update, job_id, 'failed', None, str(e))
+        end_in_flight(cache_key, future, error=e)
+        raise
+    except BaseException as e:
+        end_in_flight(cache_key, future, error=e)
+        raise
+    
+    # process_invoice has cached the result, so later duplicates hit the cache
+    end_in_flight(cache_key, future, result)
+    return result
+
+
 @app.route('/webhook', methods=['POST'])
-def webhook():
+async def webhook():
     """
     Main endpoint for Softr webhook
-    Accepts invoice file and processes it (including PDFs)
+    Accepts invoice file (including PDFs), replies 202 with a job id and
+    processes it in the background; ?wait=true processes it inline instead
     """
-    tmp_path = None
-    png_path = None
+    if request.args.get('wait', '').lower() not in ('1', 'true', 'yes'):
+        return await handle_webhook(wait=False)
     
+    if wait_slots.locked():
+        logger.warning("All %d wait slots busy - rejecting webhook", JOB_WORKERS)
+        return too_busy_response()
+    async with wait_slots:
+        return await handle_webhook(wait=True)
+
+
+async def handle_webhook(wait):
+    """/webhook itself; wait=True processes the invoice before responding"""
     try:
-        print("\n" + "="*60)
-        print("📨 Received webhook request")
-        
-        # Method 1: File upload (multipart/form-data)
-        if 'file' in request.files:
-            file = request.files['file']
-            
-            if file.filename == '':
-                return jsonify({"error": "No file selected"}), 400
-            
-            # Get file extension
-            file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else 'jpg'
-            
-            # Validate file type
-            allowed_extensions = {'png', 'jpg', 'jpeg', 'pdf', 'gif', 'webp'}
-            if file_ext not in allowed_extensions:
-                return jsonify({
-                    "error": "Invalid file type",
-                    "message": f"Allowed types: {', '.join(allowed_extensions)}"
-                }), 400
-            
-            print(f"📎 File uploaded: {file.filename} (type: {file_ext})")
-            
-            # Save temporarily
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_ext}') as tmp:
-                file.save(tmp.name)
-                tmp_path = tmp.name
-                print(f"💾 Saved to: {tmp_path}")
-        
-        # Method 2: JSON with file URL (if Softr sends URL)
-        elif request.is_json:
-            data = request.get_json()
-            file_url = data.get('file_url') or data.get('attachment_url')
-            
-            if not file_url:
-                return jsonify({"error": "No file_url provided"}), 400
-            
-            print(f"🔗 Downloading from URL: {file_url}")
-            
-            # Download file
-            import requests
-            response = requests.get(file_url)
-            
-            # Determine file type from URL or content-type
-            content_type = response.headers.get('content-type', '')
-            if 'pdf' in content_type or file_url.lower().endswith('.pdf'):
-                file_ext = 'pdf'
-            else:
-                file_ext = 'jpg'
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_ext}') as tmp:
-                tmp.write(response.content)
-                tmp_path = tmp.name
-                print(f"💾 Downloaded to: {tmp_path}")
+        logger.info("Received webhook request")
         
+        file_bytes = mime_type = None
+        image_url = await passthrough_image_url()
+        if image_url is None:
+            file_bytes, mime_type, error_response = await receive_invoice()
+            if error_response:
+                return error_response
         else:
-            return jsonify({"error": "No file provided. Send file or file_url"}), 400
+            logger.info("Passing image URL to OpenAI: %s", image_url)
         
-        print(f"📄 Processing file: {tmp_path}")
+        cache_key = invoice_cache_key(file_bytes if image_url is None else image_url.encode())
         
-        # Extract data
-        print("🤖 Extracting data with AI...")
-        invoice_data = extract_invoice_data(tmp_path)
-        print(f"✅ Extracted invoice: {invoice_data.get('invoice_number', 'N/A')}")
+        # Same invoice still being processed here - join that job. Checked
+        # before the cache: a job caches its result before leaving _in_flight
+        in_flight = _in_flight.get(cache_key)
         
-        # Save to Airtable
-        print("💾 Saving to Airtable...")
-        airtable_record = save_to_airtable(invoice_data)
-        print(f"✅ Saved to Airtable: {airtable_record['id']}")
+        # Duplicate upload - return the earlier result without calling OpenAI
+        if in_flight is None:
+            cached = await asyncio.to_thread(cache_get, cache_key)
+            if cached:
+                invoice_data, airtable_record_id = cached
+                logger.info("Duplicate invoice - using cached result (%s)", airtable_record_id)
+                return invoice_success_response(invoice_data, airtable_record_id, cached=True)
+            # A job for it may have started during the lookup
+            in_flight = _in_flight.get(cache_key)
         
-        # Clean up temporary files
-        print("🧹 Cleaning up temporary files...")
-        try:
-            if tmp_path and os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-                print(f"🗑️ Deleted: {tmp_path}")
-            
-            # Also clean up converted PNG if it exists
-            png_path = tmp_path.replace('.pdf', '.png') if tmp_path else None
-            if png_path and os.path.exists(png_path):
-                os.unlink(png_path)
-                print(f"🗑️ Deleted: {png_path}")
-        except Exception as cleanup_error:
-            print(f"⚠️ Cleanup warning: {cleanup_error}")
+        if wait:
+            if in_flight is not None:
+                job_id, future = in_flight
+                logger.info("Duplicate invoice - waiting for job %s", job_id)
+                run = asyncio.shield(future)
+            else:
+                job_id = uuid.uuid4().hex
+                future = begin_in_flight(cache_key, job_id)
+                run = run_invoice_job(job_id, file_bytes, mime_type, cache_key, image_url, future, immediate=True)
+            try:
+                invoice_data, airtable_record_id = await run
+            except AirtableWriteUnconfirmed as e:
+                # The record may exist, so don't invite a resend with 503/500 -
+                # the job is recorded as unknown for whoever checks Airtable
+                return jsonify({
+                    "success": False,
+                    "error": str(e),
+                    "job_id": job_id,
+                    "status": "unknown",
+                    "status_url": url_for('webhook_status', job_id=job_id)
+                }), 202
+            return invoice_success_response(invoice_data, airtable_record_id)
         
-        print("="*60 + "\n")
+        if in_flight is not None:
+            job_id = in_flight[0]
+            logger.info("Duplicate invoice - already processing as job %s", job_id)
+            job = await asyncio.to_thread(job_get, job_id)
+            return jsonify({
+                "success": True,
+                "message": "Invoice already queued for processing",
+                "job_id": job_id,
+                "status": job["status"] if job else "queued",
+                "status_url": url_for('webhook_status', job_id=job_id)
+            }), 202
+        
+        # Acknowledge now so Softr doesn't time out and retry while OpenAI runs.
+        # Registered before the job store write so a duplicate arriving
+        # meanwhile finds it
+        job_id = uuid.uuid4().hex
+        future = begin_in_flight(cache_key, job_id)
+        await asyncio.to_thread(job_update, job_id, 'queued')
+        try:
+            job_queue.put_nowait((job_id, file_bytes, mime_type, cache_key, image_url, future))
+        except asyncio.QueueFull:
+            end_in_flight(cache_key, future, error=RuntimeError("Job queue full"))
+            await asyncio.to_thread(job_update, job_id, 'failed', None, "Job queue full")
+            logger.warning("Job queue full (%d) - rejecting webhook", JOB_QUEUE_SIZE)
+            return too_busy_response()
+        logger.info("Queued job %s", job_id)
         
-        # Return success
         return jsonify({
             "success": True,
-            "message": "Invoice processed successfully",
-            "invoice_number": invoice_data.get("invoice_number"),
-            "total_amount": invoice_data.get("total_amount"),
-            "currency": invoice_data.get("currency"),
-            "airtable_record_id": airtable_record['id'],
-            "data": invoice_data
-        }), 200
+            "message": "Invoice queued for processing",
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": url_for('webhook_status', job_id=job_id)
+        }), 202
+    
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH - let Quart render it
+        raise
+    
+    except UPSTREAM_UNAVAILABLE_ERRORS as e:
+        logger.error("Upstream unavailable after retries: %s", e)
+        
+        return jsonify({
+            "success": False,
+            "error": "Upstream service unavailable, retry later"
+        }), 503, {"Retry-After": str(UPSTREAM_RETRY_AFTER)}
     
     except Exception as e:
-        print(f"❌ Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Webhook failed: %s", e)
+        
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
+
+@app.route('/webhook/status/<job_id>', methods=['GET'])
+async def webhook_status(job_id):
+    """Status of a job queued by /webhook, with its result once finished"""
+    job = await asyncio.to_thread(job_get, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job_id"}), 404
+    return jsonify(job)
+
+
+@app.route('/webhook/batch', methods=['POST'])
+async def webhook_batch():
+    """
+    Bulk/non-realtime variant of /webhook
+    Queues the invoice for the OpenAI Batch API (half the token cost, separate
+    rate limits); results are saved to Airtable when the batch completes
+    """
+    try:
+        logger.info("Received batch webhook request")
+        
+        file_bytes, mime_type, error_response = await receive_invoice()
+        if error_response:
+            return error_response
+        
+        cache_key = invoice_cache_key(file_bytes)
+        cached = await asyncio.to_thread(cache_get, cache_key)
+        if cached:
+            invoice_data, airtable_record_id = cached
+            logger.info("Duplicate invoice - using cached result (%s)", airtable_record_id)
+            return invoice_success_response(invoice_data, airtable_record_id, cached=True)
+        
+        # The same invoice waiting in a batch (from any worker) - return that job
+        job_id = f"{cache_key}-{uuid.uuid4().hex[:8]}"
+        queued_job_id = await asyncio.to_thread(batch_job_begin, cache_key, job_id)
+        if queued_job_id != job_id:
+            logger.info("Duplicate invoice - already queued as batch job %s", queued_job_id)
+            return jsonify({
+                "success": True,
+                "message": "Invoice already queued for batch processing",
+                "job_id": queued_job_id,
+                "status": "queued",
+                "status_url": url_for('webhook_status', job_id=queued_job_id)
+            }), 202
         
-        # Clean up on error
         try:
-            if tmp_path and os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-            png_path = tmp_path.replace('.pdf', '.png') if tmp_path else None
-            if png_path and os.path.exists(png_path):
-                os.unlink(png_path)
-        except:
-            pass
+            payload = await build_extraction_request(file_bytes, mime_type)
+            await queue_batch_request(job_id, payload)
+        except Exception as e:
+            # Don't leave a queued job that duplicates would be pointed at
+            await asyncio.to_thread(job_update, job_id, 'failed', None, str(e))
+            raise
+        
+        return jsonify({
+            "success": True,
+            "message": "Invoice queued for batch processing",
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": url_for('webhook_status', job_id=job_id)
+        }), 202
+    
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH - let Quart render it
+        raise
+    
+    except Exception as e:
+        logger.exception("Webhook failed: %s", e)
         
         return jsonify({
             "success": False,
@@ -340,14 +1875,14 @@ def webhook():
 
 
 @app.route('/health', methods=['GET'])
-def health():
+async def health():
     """Detailed health check"""
     
     # Check if PDF libraries are available
     pdf_support = False
     pdf_library = None
     try:
-        import fitz
+        fitz = _pdf_backend()
         pdf_support = True
         pdf_library = f"PyMuPDF {fitz.version[0]}"
     except ImportError as e:
@@ -367,22 +1902,26 @@ def health():
 
 
 if __name__ == '__main__':
-    print("\n" + "="*60)
-    print("🚀 Invoice Extractor API for Softr - PDF SUPPORT v2.1")
-    print("="*60)
-    print(f"📊 Airtable Base: {AIRTABLE_BASE_ID}")
-    print(f"📋 Table: {AIRTABLE_TABLE_NAME}")
+    # The development server handles one connection at a time; production
+    # runs under Hypercorn (see Procfile)
+    if os.getenv('QUART_DEV') != '1':
+        raise SystemExit(
+            "Development server disabled - run: hypercorn -c file:hypercorn_conf.py softr_webhook:app\n"
+            "(set QUART_DEV=1 to use python softr_webhook.py locally)"
+        )
+    
+    logger.info("Invoice Extractor API for Softr - PDF SUPPORT v2.1")
+    logger.info("Airtable Base: %s", AIRTABLE_BASE_ID)
+    logger.info("Table: %s", AIRTABLE_TABLE_NAME)
     
     # Check PDF support
     try:
-        import fitz
-        print(f"✅ PDF Support: PyMuPDF {fitz.version[0]}")
+        fitz = _pdf_backend()
+        logger.info("PDF Support: PyMuPDF %s", fitz.version[0])
     except ImportError:
-        print("⚠️ PDF Support: NOT AVAILABLE (PyMuPDF not installed)")
+        logger.warning("PDF Support: NOT AVAILABLE (PyMuPDF not installed)")
     
-    print(f"✅ Server running on http://0.0.0.0:5000")
-    print(f"📄 Supported formats: JPG, PNG, PDF")
-    print("\n📌 Webhook endpoint: POST /webhook")
-    print("="*60 + "\n")
+    logger.info("Server running on http://0.0.0.0:5000 - webhook endpoint: POST /webhook")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Debug mode runs the reloader; opt in with QUART_DEBUG=1
+    app.run(debug=os.getenv('QUART_DEBUG') == '1', host='0.0.0.0', port=5000)